@@ -54,6 +54,9 @@ output_format: compressed hdf5
 [lazyflow]
 threads: -1
 total_ram_mb: 0
+
+[carving]
+use_gpu: false
 """
 
 
@@ -5,6 +5,7 @@ from functools import partial
 
 import numpy
 import vigra
+from scipy import ndimage
 import fastfilters
 
 import nifty
@@ -16,6 +17,27 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+try:
+    import cupy
+    import cupyx.scipy.ndimage
+    import cucim.skimage.feature
+    import cucim.skimage.filters
+except ImportError:
+    cupy = None
+else:
+    # errors of the GPU path, after which the response can still be computed on the CPU
+    GPU_ERRORS = (
+        cupy.cuda.memory.OutOfMemoryError,
+        cupy.cuda.runtime.CUDARuntimeError,
+        cupy.cuda.driver.CUDADriverError,
+        cupy.cuda.compiler.CompileException,
+    )
+
+
+# number of elements per block for streaming element-wise operations,
+# 256 KiB of float32 values stay in cache between consecutive operations
+STREAM_BLOCK_SIZE = 2**16
+
 
 # helper function to cast nifty.tools.Block to a slice
 def block_to_slicing(block):
@@ -27,21 +49,77 @@ def choose_channel(data, sigma, function, channel):
     return function(data, sigma)[..., channel]
 
 
+# derivative order of the filters, used for halo calculation and to check valid filters
+FILTER_ORDERS = {
+    "gaussianSmoothing": 0,
+    "gaussianGradientMagnitude": 1,
+    "hessianOfGaussianEigenvalues": 2,
+    "structureTensorEigenvalues": 1,
+    "laplacianOfGaussian": 2,
+}
+
+
+def default_halo(sigma, order, ndim):
+    """Calculate the default halo for a filter of the given derivative order on the sigma - value, see
+    https://github.com/ukoethe/vigra/blob/fb427440da8c42f96e14ebb60f7f22bdf0b7b1b2/include/vigra/multi_blockwise.hxx#L408
+    """
+    return ndim * [int(ceil(3.0 * sigma + 0.5 * order + 0.5))]
+
+
+def hessian_eigval_channel(which, ndim):
+    """Return the channel of the largest ("max") or smallest ("min") hessian eigenvalue."""
+    if which not in ("min", "max"):
+        raise ValueError(f"{which} is not a valid eigenvalue selection")
+    # eigenvalues are sorted in decreasing order
+    return 0 if which == "max" else ndim - 1
+
+
+def _filter_blockwise(filter_function, data, sigma, halo, response, max_workers, block_shape=None, reduction=None):
+    """Apply filter function over blocks with halo in parallel and write the result to response.
+
+    If reduction is given, it is applied to each block of the response
+    while it is computed, and the list of per-block results is returned.
+    """
+    ndim = data.ndim
+    shape = data.shape
+
+    # get values for block shape and halo and make blocking
+    if block_shape is None:
+        # we choose different default block-shapes for 2d and 3d,
+        # but it might be worth to thinkg this through a bit further
+        block_shape = 3 * [128] if ndim == 3 else 2 * [256]
+
+    blocking = nifty.tools.blocking(ndim * [0], shape, block_shape)
+
+    def filter_block(block_index):
+        # get the block with halo and the slicings corresponding to
+        # the block with halo, the block without halo and the
+        # block without halo in loocal coordinates
+        block = blocking.getBlockWithHalo(blockIndex=block_index, halo=halo)
+        inner_slicing = block_to_slicing(block.innerBlock)
+        outer_slicing = block_to_slicing(block.outerBlock)
+        inner_local_slicing = block_to_slicing(block.innerBlockLocal)
+
+        block_data = data[outer_slicing]
+        block_response = filter_function(block_data, sigma)
+
+        block_response = block_response[inner_local_slicing]
+        response[inner_slicing] = block_response
+        if reduction is not None:
+            return reduction(block_response)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        tasks = [executor.submit(filter_block, block_index) for block_index in range(blocking.numberOfBlocks)]
+        return [t.result() for t in tasks]
+
+
 def parallel_filter(filter_name, data, sigma, max_workers, block_shape=None, outer_scale=None, return_channel=None):
     """Compute fiter response parallel over blocks."""
-    # order values for halo calculation, also used to check valid filters
-    order_values = {
-        "gaussianSmoothing": 0,
-        "gaussianGradientMagnitude": 1,
-        "hessianOfGaussianEigenvalues": 2,
-        "structureTensorEigenvalues": 1,
-        "laplacianOfGaussian": 2,
-    }
-    if filter_name not in order_values:
+    if filter_name not in FILTER_ORDERS:
         raise ValueError(f"{filter_name} is not a valid filter")
 
     filter_function = getattr(fastfilters, filter_name)
-    order = order_values[filter_name]
+    order = FILTER_ORDERS[filter_name]
     if filter_name == "structureTensorEigenvalues":
         assert outer_scale is not None, "Need outer_scale for structureTensorEigenvalues"
         filter_function = partial(filter_function, outerScale=outer_scale)
@@ -52,9 +130,7 @@ def parallel_filter(filter_name, data, sigma, max_workers, block_shape=None, out
         sigma_ = sigma
 
     ndim = data.ndim
-    # calculate the default halo on the sigma - value, see
-    # https://github.com/ukoethe/vigra/blob/fb427440da8c42f96e14ebb60f7f22bdf0b7b1b2/include/vigra/multi_blockwise.hxx#L408
-    halo = ndim * [int(ceil(3.0 * sigma_ + 0.5 * order + 0.5))]
+    halo = default_halo(sigma_, order, ndim)
 
     shape = data.shape
     multi_channel = filter_name in ("hessianOfGaussianEigenvalues", "structureTensorEigenvalues")
@@ -72,38 +148,201 @@ def parallel_filter(filter_name, data, sigma, max_workers, block_shape=None, out
     else:
         out_shape = shape
 
-    # get values for block shape and halo and make blocking
-    if block_shape is None:
-        # we choose different default block-shapes for 2d and 3d,
-        # but it might be worth to thinkg this through a bit further
-        block_shape = 3 * [128] if ndim == 3 else 2 * [256]
-
-    blocking = nifty.tools.blocking(ndim * [0], shape, block_shape)
-
     # allocate the filter response
     response = numpy.zeros(out_shape, dtype="float32")
+    _filter_blockwise(filter_function, data, sigma, halo, response, max_workers, block_shape)
 
-    def filter_block(block_index):
-        # get the block with halo and the slicings corresponding to
-        # the block with halo, the block without halo and the
-        # block without halo in loocal coordinates
-        block = blocking.getBlockWithHalo(blockIndex=block_index, halo=halo)
-        inner_slicing = block_to_slicing(block.innerBlock)
-        outer_slicing = block_to_slicing(block.outerBlock)
-        inner_local_slicing = block_to_slicing(block.innerBlockLocal)
+    return response
+
+
+def hessian_eigval_selected(data, sigma, which, max_workers, block_shape=None, invert=False):
+    """Compute the largest ("max") or smallest ("min") hessian of gaussian eigenvalue parallel over blocks.
+
+    Only the selected eigenvalue channel of each block is kept.
+    If invert is set, the response is inverted w.r.t. its maximum, which is
+    accumulated per block while the eigenvalues are computed.
+    """
+    channel = hessian_eigval_channel(which, data.ndim)
+    halo = default_halo(sigma, FILTER_ORDERS["hessianOfGaussianEigenvalues"], data.ndim)
+    response = numpy.zeros(data.shape, dtype="float32")
+    block_maxima = _filter_blockwise(
+        partial(choose_channel, function=fastfilters.hessianOfGaussianEigenvalues, channel=channel),
+        data,
+        sigma,
+        halo,
+        response,
+        max_workers,
+        block_shape,
+        reduction=numpy.max if invert else None,
+    )
+
+    if invert:
+        vmax = max(block_maxima)
+        _parallel_stream(lambda block: numpy.subtract(vmax, block, out=block), response, max_workers)
+
+    return response
 
-        block_data = data[outer_slicing]
-        block_response = filter_function(block_data, sigma)
 
-        response[inner_slicing] = block_response[inner_local_slicing]
+def _gaussian_pass(source, target, sigma, axis, max_workers):
+    # the 1d passes are independent along any other axis, so we can parallelize
+    # over slabs along that axis without needing a halo
+    slab_axis = 1 if axis == 0 else 0
+    n_slabs = min(source.shape[slab_axis], 4 * max_workers)
+    bounds = numpy.linspace(0, source.shape[slab_axis], n_slabs + 1).astype(int)
+
+    def smooth_slab(begin, end):
+        slicing = (slice(None),) * slab_axis + (slice(begin, end),)
+        # mirror border and 3 sigma window to match vigra / fastfilters
+        ndimage.gaussian_filter1d(
+            source[slicing], sigma, axis=axis, output=target[slicing], mode="mirror", truncate=3.0
+        )
 
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        tasks = [executor.submit(filter_block, block_index) for block_index in range(blocking.numberOfBlocks)]
+        tasks = [executor.submit(smooth_slab, begin, end) for begin, end in zip(bounds[:-1], bounds[1:])]
         [t.result() for t in tasks]
 
+
+def parallel_gaussian_smoothing(data, sigma, max_workers):
+    """Compute gaussian smoothing as separable 1d passes, parallel over slabs.
+
+    Compared to filtering blocks with halo, this needs no redundant computation
+    and only a single intermediate buffer, which the passes alternate with the output.
+    """
+    ndim = data.ndim
+    response = numpy.empty(data.shape, dtype="float32")
+    tmp = numpy.empty_like(response)
+    # alternate between the two buffers such that the last pass writes to the response
+    buffers = (response, tmp) if ndim % 2 == 1 else (tmp, response)
+
+    source = data
+    for axis in range(ndim):
+        target = buffers[axis % 2]
+        _gaussian_pass(source, target, sigma, axis, max_workers)
+        source = target
+
     return response
 
 
+def _stream_blocks(data, block_size=STREAM_BLOCK_SIZE):
+    """Yield cache-sized flat views of data."""
+    if not data.flags.c_contiguous:
+        # no flat view possible without copying, fall back to the whole array
+        yield data
+        return
+    flat = data.reshape(-1)
+    for start in range(0, flat.size, block_size):
+        yield flat[start : start + block_size]
+
+
+def _parallel_stream(function, data, max_workers):
+    """Apply function to cache-sized blocks of data in parallel and return the results."""
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(function, _stream_blocks(data)))
+
+
+def parallel_minmax(data, max_workers):
+    """Compute min and max of data in a single pass, parallel over threads.
+
+    Each thread streams through a contiguous part of the data in cache-sized
+    blocks and keeps its own min and max, which are merged in the end.
+    """
+
+    def minmax(part):
+        vmin, vmax = numpy.inf, -numpy.inf
+        for block in _stream_blocks(part):
+            vmin = min(vmin, block.min())
+            vmax = max(vmax, block.max())
+        return vmin, vmax
+
+    parts = numpy.array_split(data.reshape(-1), max_workers) if data.flags.c_contiguous else [data]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        minima, maxima = zip(*executor.map(minmax, parts))
+    return min(minima), max(maxima)
+
+
+def minmax_rescale_inplace(data, upper=255.0, max_workers=1):
+    """Rescale data in-place to the range [0, upper] and return the original (min, max).
+
+    Min and max are computed in one streamed pass over cache-sized blocks,
+    the rescaling in a second one, both parallel over threads;
+    constant data is set to zero.
+    """
+    vmin, vmax = parallel_minmax(data, max_workers)
+
+    scale = upper / (vmax - vmin) if vmax > vmin else 0.0
+
+    def rescale(block):
+        block -= vmin
+        block *= scale
+
+    _parallel_stream(rescale, data, max_workers)
+    return vmin, vmax
+
+
+def gpu_available():
+    """Check whether filters can be computed on a CUDA device via cuCIM."""
+    if cupy is None:
+        return False
+    try:
+        return cupy.cuda.runtime.getDeviceCount() > 0
+    except cupy.cuda.runtime.CUDARuntimeError:
+        return False
+
+
+class GPUFilterError(RuntimeError):
+    """Raised if a filter response could not be computed on the GPU."""
+
+
+def gpu_filter(filter_name, data, sigma, return_channel=None, invert=False):
+    """Compute filter response on the GPU with cuCIM.
+
+    If invert is set, the response is inverted w.r.t. its maximum before
+    it is copied back to the host.
+    Raises GPUFilterError if the GPU fails, e.g. if the volume does not fit into its memory.
+    """
+    try:
+        return _gpu_filter(filter_name, data, sigma, return_channel, invert)
+    except GPU_ERRORS as e:
+        raise GPUFilterError(f"{filter_name} of shape {data.shape} failed on the GPU: {e}") from e
+    finally:
+        # don't keep the device memory reserved, other GPU users (e.g. neural network workflows) may need it
+        cupy.get_default_memory_pool().free_all_blocks()
+
+
+def _gpu_filter(filter_name, data, sigma, return_channel, invert):
+    data_gpu = cupy.asarray(data, dtype="float32")
+
+    # smoothing and gradient magnitude use the same border treatment and kernel radius as vigra / fastfilters,
+    # (3 + 0.5 * order) * sigma, but cupyx normalizes the derivative kernels differently,
+    # so the gradient magnitudes differ slightly
+    if filter_name == "gaussianSmoothing":
+        response = cucim.skimage.filters.gaussian(data_gpu, sigma, mode="mirror", truncate=3.0)
+    elif filter_name == "gaussianGradientMagnitude":
+        response = cupyx.scipy.ndimage.gaussian_gradient_magnitude(data_gpu, sigma, mode="mirror", truncate=3.5)
+    elif filter_name == "hessianOfGaussianEigenvalues":
+        # hessian_matrix has no truncate parameter and uses its own derivative kernels,
+        # so the response is not numerically identical to fastfilters
+        hessian = cucim.skimage.feature.hessian_matrix(
+            data_gpu, sigma, mode="mirror", order="rc", use_gaussian_derivatives=True
+        )
+        # eigenvalues are sorted in decreasing order along the first axis, like the channels of fastfilters
+        eigenvalues = cucim.skimage.feature.hessian_matrix_eigvals(hessian)
+        del hessian
+        if return_channel is None:
+            response = cupy.moveaxis(eigenvalues, 0, -1)
+        else:
+            assert return_channel < data.ndim, f"{return_channel} must be smaller than {data.ndim}"
+            response = eigenvalues[return_channel]
+    else:
+        raise ValueError(f"{filter_name} is not supported on the GPU")
+
+    if invert:
+        # in-place, to not allocate another volume on the device
+        cupy.subtract(response.max(), response, out=response)
+
+    return cupy.asnumpy(response.astype("float32", copy=False))
+
+
 # TODO it would make sense to apply an additional size filter here
 def parallel_watershed(data, block_shape=None, halo=None, max_workers=None):
     """Parallel watershed with hard block boundaries."""
@@ -35,18 +35,72 @@ from lazyflow.request import Request
 
 from lazyflow.utility.helpers import eq_shapes
 from lazyflow.utility.timer import Timer
+import ilastik.config
 from ilastik.applets.base.applet import DatasetConstraintError
 
 # carving backend in ilastiktools
 from .watershed_segmentor import WatershedSegmentor
 
-from .carvingTools import watershed_and_agglomerate, parallel_filter
+from .carvingTools import (
+    watershed_and_agglomerate,
+    parallel_filter,
+    parallel_gaussian_smoothing,
+    hessian_eigval_selected,
+    hessian_eigval_channel,
+    minmax_rescale_inplace,
+    gpu_available,
+    gpu_filter,
+    GPUFilterError,
+)
 
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+# The filter functions of OpFilter compute the whole response on the GPU if it is enabled
+# in the config ("use_gpu" in the "carving" section) and one is available, and parallel on
+# the CPU otherwise. The GPU responses are not identical to the CPU ones, so this is opt-in.
+
+
+def _gpu_response(filter_name, fvol, sigma, **kwargs):
+    """Compute the response with gpu_filter, or return None if it has to be computed on the CPU."""
+    if not (ilastik.config.cfg.getboolean("carving", "use_gpu") and gpu_available()):
+        return None
+    try:
+        return gpu_filter(filter_name, fvol, sigma, **kwargs)
+    except GPUFilterError as e:
+        logger.warning("%s, falling back to the CPU", e)
+        return None
+
+
+def _hessian_eigenvalue(fvol, sigma, max_workers, which, invert=False):
+    channel = hessian_eigval_channel(which, fvol.ndim)
+    response = _gpu_response("hessianOfGaussianEigenvalues", fvol, sigma, return_channel=channel, invert=invert)
+    if response is None:
+        # only the selected eigenvalue channel is kept, per block
+        response = hessian_eigval_selected(fvol, sigma, which, max_workers=max_workers, invert=invert)
+    return response
+
+
+def _gradient_magnitude(fvol, sigma, max_workers):
+    response = _gpu_response("gaussianGradientMagnitude", fvol, sigma)
+    if response is None:
+        response = parallel_filter("gaussianGradientMagnitude", fvol, sigma, max_workers=max_workers)
+    return response
+
+
+def _gaussian_smoothing(fvol, sigma, max_workers, negate=False):
+    response = _gpu_response("gaussianSmoothing", fvol, sigma)
+    if response is None:
+        # separable smoothing, one 1d pass per axis
+        response = parallel_gaussian_smoothing(fvol, sigma, max_workers=max_workers)
+    # smoothing is linear, so we can invert the response instead of the input
+    if negate:
+        numpy.negative(response, out=response)
+    return response
+
+
 class OpFilter(Operator):
     HESSIAN_BRIGHT = 0
     HESSIAN_DARK = 1
@@ -54,12 +108,15 @@ class OpFilter(Operator):
     RAW = 3
     RAW_INVERTED = 4
 
-    FILTER_NAMES = {
-        0: "hessianOfGaussianEigenvalues",
-        1: "hessianOfGaussianEigenvalues",
-        2: "gaussianGradientMagnitude",
-        3: "gaussianSmoothing",
-        4: "gaussianSmoothing",
+    # filter -> (function, keyword arguments) computing the response
+    FILTER_FUNCTIONS = {
+        # HESSIAN_BRIGHT -> smallest eigenvalue, inverted
+        HESSIAN_BRIGHT: (_hessian_eigenvalue, {"which": "min", "invert": True}),
+        # HESSIAN_DARK -> largest eigenvalue
+        HESSIAN_DARK: (_hessian_eigenvalue, {"which": "max"}),
+        STEP_EDGES: (_gradient_magnitude, {}),
+        RAW: (_gaussian_smoothing, {}),
+        RAW_INVERTED: (_gaussian_smoothing, {"negate": True}),
     }
 
     Input = InputSlot()
@@ -74,15 +131,20 @@ class OpFilter(Operator):
         self.Output.meta.assignFrom(self.Input.meta)
         self.Output.meta.dtype = numpy.float32
 
-    def execute(self, slot, subindex, roi, result):
-        # make sure raw data is 5D: t,{x,y,z},c
+        # raw data must be 5D: t,{x,y,z},c - checked once here instead of on every execute
         ax = self.Input.meta.axistags
         sh = self.Input.meta.shape
-        assert len(ax) == 5
-        assert ax[0].key == "t" and sh[0] == 1
-        for i in range(1, 4):
-            assert ax[i].isSpatial()
-        assert ax[4].key == "c" and sh[4] == 1
+        self._input_is_5d = (
+            len(ax) == 5
+            and ax[0].key == "t"
+            and sh[0] == 1
+            and all(ax[i].isSpatial() for i in range(1, 4))
+            and ax[4].key == "c"
+            and sh[4] == 1
+        )
+
+    def execute(self, slot, subindex, roi, result):
+        assert self._input_is_5d, f"Expected 5D raw data t,{{x,y,z}},c, got {self.Input.meta.getTaggedShape()}"
 
         volume5d = self.Input.value
         sigma = self.Sigma.value
@@ -91,47 +153,34 @@ class OpFilter(Operator):
 
         logger.info("input volume shape: %r" % (volume.shape,))
         logger.info("input volume size: %r MB", (old_div(volume.nbytes, 1024**2),))
-        fvol = numpy.asarray(volume, numpy.float32)
+
+        # check dimensionality of input and reduce to 2d volume
+        # if we have actual 2d input (views only, nothing is copied)
+        if volume.shape[2] == 1:
+            volume = volume[:, :, 0]
+            result_view = result_view[:, :, 0]
 
         # Choose filter selected by user
         volume_filter = self.Filter.value
-        filter_name = self.FILTER_NAMES[volume_filter]
+        filter_function, filter_kwargs = self.FILTER_FUNCTIONS[volume_filter]
 
-        logger.info("applying filter on shape = %r" % (fvol.shape,))
+        logger.info("applying filter on shape = %r" % (volume.shape,))
         with Timer() as filterTimer:
 
-            # check dimensionality of input and reduce to 2d volume
-            # if we have actual 2d input
-            if fvol.shape[2] == 1:
-                fvol = fvol[:, :, 0]
-
-            # we need to invert the input for filter mode RAW_INVERTED
-            if volume_filter == OpFilter.RAW_INVERTED:
-                fvol = -fvol
-
-            # for the hessian filters, we only need to keep one channel,
-            # and we discard the other channels during block-wise computation to save memory
-            if volume_filter == OpFilter.HESSIAN_BRIGHT:  # HESSIAN_BRIGHT -> last eigenvalue
-                channel = fvol.ndim - 1
-            elif volume_filter == OpFilter.HESSIAN_DARK:  # HESSIAN_DARK -> first eigenvalue
-                channel = 0
+            if volume.dtype == numpy.float32:
+                fvol = volume
             else:
-                channel = None
+                # Save memory: use result as float32 scratch for the converted input,
+                # it is only overwritten by the response once filtering is done
+                fvol = result_view
+                numpy.copyto(fvol, volume, casting="unsafe")
 
             # handle the special case of the Request threadpool not having any workers
             max_workers = max(1, Request.global_thread_pool.num_workers)
-            # compute the filter response block-wise
-            response = parallel_filter(filter_name, fvol, sigma, max_workers=max_workers, return_channel=channel)
-
-            # need to invert response for hessian bright
-            if volume_filter == OpFilter.HESSIAN_BRIGHT:
-                response = numpy.max(response) - response
+            response = filter_function(fvol, sigma, max_workers=max_workers, **filter_kwargs)
 
             # write the response to result view
-            if fvol.ndim == 2:
-                result_view[:, :, 0] = response
-            else:
-                result_view[...] = response
+            result_view[...] = response
 
             logger.info("Filter took {} seconds".format(filterTimer.seconds()))
 
@@ -151,20 +200,34 @@ class OpNormalize255(Operator):
     def execute(self, slot, subindex, roi, result):
         # Save memory: use result as a temporary
         self.Input(roi.start, roi.stop).writeInto(result).wait()
-        volume_max = numpy.max(result)
-        volume_min = numpy.min(result)
 
         # result[...] = (result - volume_min) * 255.0 / (volume_max-volume_min)
-        # Avoid temporaries...
-        result[:] -= volume_min
-        result[:] *= 255.0
-        result[:] /= volume_max - volume_min
+        # Avoid temporaries and stream through the volume block-wise
+        minmax_rescale_inplace(result, 255.0, max_workers=max(1, Request.global_thread_pool.num_workers))
         return result
 
     def propagateDirty(self, slot, subindex, roi):
         self.Output.setDirty(roi.start, roi.stop)
 
 
+def _read_float32(slot, out, slab_size=16):
+    """Read the whole volume of slot into the float32 array out.
+
+    Other dtypes are requested in slabs along the first spatial axis and converted
+    slab by slab, so no full volume of the slot's dtype is held next to out.
+    """
+    start, stop = roiFromShape(slot.meta.shape)
+    if numpy.dtype(slot.meta.dtype) == numpy.float32:
+        slot(start, stop).writeInto(out).wait()
+        return out
+
+    for begin in range(0, slot.meta.shape[1], slab_size):
+        end = min(begin + slab_size, slot.meta.shape[1])
+        start[1], stop[1] = begin, end
+        out[:, begin:end] = slot(start, stop).wait()
+    return out
+
+
 class OpSimpleBlockwiseWatershed(Operator):
     Input = InputSlot()
     Output = OutputSlot()
@@ -177,34 +240,45 @@ class OpSimpleBlockwiseWatershed(Operator):
         self.Output.meta.assignFrom(self.Input.meta)
         self.Output.meta.dtype = numpy.uint32
 
+        # resolve everything that only depends on the slot setup here, instead of on every execute
+        self._axes_supported = self.Input.meta.getAxisKeys() == list("txyzc")
+        if self._axes_supported and self.Input.meta.getTaggedShape()["z"] > 1:
+            self._result_idx = numpy.s_[0, ..., 0]
+        else:
+            self._result_idx = numpy.s_[0, ..., 0, 0]
+
+        self._watershed = self._watershed_and_agglomerate if self.DoAgglo.value else self._watershed_only
+
+    def _watershed_and_agglomerate(self, input_):
+        return watershed_and_agglomerate(
+            input_,
+            max_workers=max(1, Request.global_thread_pool.num_workers),
+            size_regularizer=self.SizeRegularizer.value,
+            reduce_to=self.ReduceTo.value,
+        )
+
+    def _watershed_only(self, input_):
+        return vigra.analysis.watershedsNew(input_)
+
     def execute(self, slot, subindex, roi, result):
         if tuple(roi.stop - roi.start) != self.Output.meta.shape:
             raise ValueError("Blockwise Watershed must be run on the entire volume")
 
-        if self.Input.meta.getAxisKeys() != list("txyzc"):
+        if not self._axes_supported:
             raise ValueError(f"Unsupported input axis keys {self.Input.meta.getAxisKeys()}")
 
-        if self.Input.meta.getTaggedShape()["z"] > 1:
-            result_idx = numpy.s_[0, ..., 0]
-        else:
-            result_idx = numpy.s_[0, ..., 0, 0]
-
-        input_ = self.Input(roi.start, roi.stop).wait().squeeze()
+        # vigra's watershed and nifty's edge accumulation work on float32,
+        # reading into a float32 buffer means the volume is not converted again
+        input_ = _read_float32(self.Input, numpy.empty(self.Input.meta.shape, dtype=numpy.float32))
+        # squeeze returns a view, the volume is not copied again
+        input_ = input_.squeeze()
         if input_.ndim not in (2, 3):
             raise ValueError(f"Input shape {input_.shape} has an invalid number of non-singleton dimensions")
 
         with Timer() as timer:
             logger.info("Run block-wise watershed in %dd", input_.ndim)
 
-            if self.DoAgglo.value:
-                result[result_idx], max_id = watershed_and_agglomerate(
-                    input_,
-                    max_workers=max(1, Request.global_thread_pool.num_workers),
-                    size_regularizer=self.SizeRegularizer.value,
-                    reduce_to=self.ReduceTo.value,
-                )
-            else:
-                result[result_idx], max_id = vigra.analysis.watershedsNew(input_)
+            result[self._result_idx], max_id = self._watershed(input_)
 
             logger.info("done %d", max_id)
             logger.info("Blockwise Watershed took %f seconds", timer.seconds())
@@ -235,9 +309,10 @@ class OpMstSegmentorProvider(Operator):
         # first thing, show the user that we are waiting for computations to finish
         self.applet.progressSignal(-1)
         try:
-            volume_feat = self.Image(*roiFromShape(self.Image.meta.shape)).wait()
             labelVolume = self.LabelImage(*roiFromShape(self.LabelImage.meta.shape)).wait()
 
+            volume_feat = self.Image(*roiFromShape(self.Image.meta.shape)).wait()
+
             self.applet.progress = 0
 
             def updateProgressBar(x):
@@ -307,6 +382,9 @@ class OpPreprocessing(Operator):
     # Filter +----+                                                   +-> FilteredImage
 
     # *note: Raw/Input filters used for inversion and smoothing only.
+    # *note: the segmentation branch must read the normalized [0, 255] response, not only the display:
+    #        OpCarving.NoBiasBelow is given on that scale, and the agglomeration in
+    #        OpSimpleBlockwiseWatershed is not invariant to offsets of its edge strengths.
 
     def __init__(self, *args, **kwargs):
         super(OpPreprocessing, self).__init__(*args, **kwargs)
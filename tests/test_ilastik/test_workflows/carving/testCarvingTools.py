@@ -127,3 +127,78 @@ class TestCarvingTools(unittest.TestCase):
         res = parallel_filter(name, x, sigma, outer_scale=outer_scale, max_workers=4)
         exp = fastfilters.structureTensorEigenvalues(x, sigma, outer_scale)
         assert numpy.allclose(res, exp)
+
+    def test_gpu_filter(self):
+        from ilastik.workflows.carving.carvingTools import gpu_available, gpu_filter
+
+        if not gpu_available():
+            self.skipTest("No CUDA device available")
+
+        shape = 3 * (64,)
+        x = numpy.random.rand(*shape).astype("float32")
+        sigma = 1.6
+
+        # window size and border treatment match fastfilters, but the derivative kernels are normalized differently
+        for filt, atol in (("gaussianSmoothing", 1e-3), ("gaussianGradientMagnitude", 1e-2)):
+            res = gpu_filter(filt, x, sigma)
+            exp = getattr(fastfilters, filt)(x, sigma)
+            assert res.shape == exp.shape
+            assert numpy.allclose(res, exp, atol=atol)
+
+        # cuCIM uses its own derivative kernels for the hessian, so we only check the channel order here
+        largest = gpu_filter("hessianOfGaussianEigenvalues", x, sigma, return_channel=0)
+        smallest = gpu_filter("hessianOfGaussianEigenvalues", x, sigma, return_channel=2)
+        assert largest.shape == smallest.shape == shape
+        assert (largest >= smallest).all()
+
+    def test_hessian_eigval_selected(self):
+        from ilastik.workflows.carving.carvingTools import hessian_eigval_selected
+
+        sigma = 1.6
+        for shape in (2 * (256,), 3 * (64,)):
+            x = numpy.random.rand(*shape).astype("float32")
+            exp = fastfilters.hessianOfGaussianEigenvalues(x, sigma)
+
+            for which, channel in (("max", 0), ("min", len(shape) - 1)):
+                res = hessian_eigval_selected(x, sigma, which, max_workers=4)
+                assert res.shape == shape
+                assert res.dtype == numpy.float32
+                assert numpy.allclose(res, exp[..., channel])
+
+                inverted = hessian_eigval_selected(x, sigma, which, max_workers=4, invert=True)
+                assert numpy.allclose(inverted, res.max() - res)
+
+    def test_parallel_minmax(self):
+        from ilastik.workflows.carving.carvingTools import parallel_minmax
+
+        x = numpy.random.rand(1, 70, 80, 90, 1).astype("float32")
+        for max_workers in (1, 4):
+            assert parallel_minmax(x, max_workers) == (x.min(), x.max())
+        assert parallel_minmax(x[:, ::2], 4) == (x[:, ::2].min(), x[:, ::2].max())
+
+    def test_minmax_rescale_inplace(self):
+        from ilastik.workflows.carving.carvingTools import minmax_rescale_inplace
+
+        x = (numpy.random.rand(1, 70, 80, 90, 1).astype("float32") - 0.3) * 40
+        exp_min, exp_max = x.min(), x.max()
+        exp = (x - exp_min) * 255.0 / (exp_max - exp_min)
+
+        vmin, vmax = minmax_rescale_inplace(x)
+        assert (vmin, vmax) == (exp_min, exp_max)
+        assert x.min() == 0
+        assert numpy.allclose(x, exp, atol=1e-3)
+
+        constant = numpy.full((10, 10), 3.0, dtype="float32")
+        minmax_rescale_inplace(constant)
+        assert (constant == 0).all()
+
+    def test_parallel_gaussian_smoothing(self):
+        from ilastik.workflows.carving.carvingTools import parallel_gaussian_smoothing
+
+        for shape in (2 * (256,), 3 * (64,)):
+            x = numpy.random.rand(*shape).astype("float32")
+            for sigma in (0.7, 1.6, 3.2):
+                res = parallel_gaussian_smoothing(x, sigma, max_workers=4)
+                exp = fastfilters.gaussianSmoothing(x, sigma)
+                assert res.shape == exp.shape
+                assert numpy.allclose(res, exp, atol=1e-4)
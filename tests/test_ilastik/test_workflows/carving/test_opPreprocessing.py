@@ -29,7 +29,12 @@ from lazyflow.graph import Graph
 from lazyflow.utility import is_root_cause
 from lazyflow.request import RequestError
 
-from ilastik.workflows.carving.opPreprocessing import OpSimpleBlockwiseWatershed
+import ilastik.config
+from ilastik.workflows.carving.carvingTools import GPUFilterError
+from ilastik.workflows.carving.opPreprocessing import (
+    OpFilter,
+    OpSimpleBlockwiseWatershed,
+)
 
 
 @pytest.mark.parametrize(
@@ -54,3 +59,38 @@ def test_OpSimpleBlockwiseWatershed_dimensions(shape, do_agglo, expectation, exp
         op.Output[:].wait()
         if exp_root_cause:
             assert is_root_cause(exp_root_cause, exc_info.value)
+
+
+def test_OpFilter_falls_back_to_cpu_on_gpu_error(monkeypatch):
+    from ilastik.workflows.carving import opPreprocessing
+
+    data = vigra.taggedView(np.random.rand(1, 32, 32, 32, 1).astype("float32"), "txyzc")
+
+    monkeypatch.setattr(opPreprocessing, "gpu_available", lambda: False)
+    op = OpFilter(graph=Graph())
+    op.Input.setValue(data)
+    op.Filter.setValue(OpFilter.STEP_EDGES)
+    expected = op.Output[:].wait()
+
+    def out_of_memory(*args, **kwargs):
+        raise GPUFilterError("out of GPU memory")
+
+    monkeypatch.setitem(ilastik.config.cfg["carving"], "use_gpu", "true")
+    monkeypatch.setattr(opPreprocessing, "gpu_available", lambda: True)
+    monkeypatch.setattr(opPreprocessing, "gpu_filter", out_of_memory)
+    op = OpFilter(graph=Graph())
+    op.Input.setValue(data)
+    op.Filter.setValue(OpFilter.STEP_EDGES)
+    np.testing.assert_array_equal(op.Output[:].wait(), expected)
+
+
+def test_OpFilter_raw_inverted_is_negated_raw():
+    data = vigra.taggedView((np.random.rand(1, 32, 32, 32, 1) * 1000).astype("uint16"), "txyzc")
+    responses = {}
+    for volume_filter in (OpFilter.RAW, OpFilter.RAW_INVERTED):
+        op = OpFilter(graph=Graph())
+        op.Input.setValue(data)
+        op.Filter.setValue(volume_filter)
+        responses[volume_filter] = op.Output[:].wait()
+
+    np.testing.assert_array_equal(responses[OpFilter.RAW_INVERTED], -responses[OpFilter.RAW])